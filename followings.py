@@ -18,16 +18,22 @@ Please see the README file for installation/configuration help.
 """
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime, timezone
+import atexit
 import os
-import pickle
-import shutil
-
-from mastodon import Mastodon
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from mastodon import (Mastodon, MastodonError, MastodonNetworkError,
+                      MastodonNotFoundError, MastodonVersionError)
 from tqdm import tqdm
 import requests
-import dateutil
-import dateutil.parser
+from requests.adapters import HTTPAdapter
 from colorama import Fore, Style, init as colorama_init
 
 import settings
@@ -35,9 +41,47 @@ import settings
 
 HTTP_TIMEOUT = 6
 
+SKIP_INSTANCES = frozenset(settings.SKIP_INSTANCES)
+ASSUME_DEAD_INSTANCES = frozenset(settings.ASSUME_DEAD_INSTANCES)
+
+# Commit the cache to disk after this many writes
+CACHE_COMMIT_EVERY = 100
+
+# Bump when the cache tables change; older caches are then discarded
+CACHE_SCHEMA_VERSION = 2
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS toots (
+    fid INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,
+    payload TEXT,
+    checked_at INTEGER NOT NULL
+);
+"""
+
+# How long gone users and dead instances are remembered
+NEGATIVE_TTL = timedelta(days=7)
+
+# Concurrent status lookups (all of them go to our own server)
+MAX_WORKERS = 16
+
+# ASSUME_DEAD_INSTANCES are probed once per run before looking up their users
+PROBE_TIMEOUT = 3
+host_up = {}
+host_probe_locks = defaultdict(threading.Lock)
+host_probe_locks_lock = threading.Lock()
+
+# Accounts per page of followings/followers (the API caps this at 80)
+PAGE_SIZE = 80
+
+# Accounts per /api/v1/accounts/relationships request
+RELATIONSHIPS_BATCH = 40
+
+
+RESET = Fore.WHITE + Style.NORMAL
+
 
 def cprint(c, s):
-    print(c + s + Fore.WHITE + Style.NORMAL)
+    print(c + s + RESET)
 
 
 def parse_time_ago(v):
@@ -54,43 +98,213 @@ class Error(Exception):
     pass
 
 
-class UserGone(Exception):
-    pass
-
-
-
-def get_last_toot(mastodon, fid, force=False):
-
-    if settings.CACHE_FILE:
+def instance_of(acct):
+    if '@' in acct:
+        return acct.split('@', 1)[1].lower()
+    return None
+
+
+def is_skipped(account):
+    return instance_of(account.get('acct')) in SKIP_INSTANCES
+
+
+def chunks(seq, n):
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+
+def iter_pages(mastodon, page):
+    """Yield the pages of a paginated result as they are fetched."""
+    while page:
+        yield page
+        page = mastodon.fetch_next(page)
+
+
+def fetch_ahead(executor, fn, items, window, skip=None):
+    """
+    Yield (item, future) pairs in order, keeping up to `window` calls to
+    fn(item) running in the executor ahead of the consumer. Items for
+    which skip(item) is true are yielded with no future. Calls not yet
+    started are cancelled when the generator is closed early.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            if skip and skip(item):
+                future = None
+            else:
+                future = executor.submit(fn, item)
+            pending.append((item, future))
+            if len(pending) >= window:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for item, future in pending:
+            if future:
+                future.cancel()
+
+
+class Cache:
+    """
+    Last toots of followings, kept in SQLite so that each update is a
+    single row write. Shared between the worker threads.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.conn = sqlite3.connect(path or ':memory:',
+                                    check_same_thread=False)
         try:
-            with open(settings.CACHE_FILE, 'rb') as f:
-                cache = pickle.load(f)
-        except Exception as e:
-            cprint(Fore.RED, "Error loading cache: {}".format(e))
-            cache = {}
-    else:
-        cache = {}
+            self._setup()
+        except sqlite3.DatabaseError:
+            self.conn.close()
+            raise
+
+    def _setup(self):
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != CACHE_SCHEMA_VERSION:
+            self.conn.execute('DROP TABLE IF EXISTS toots')
+            self.conn.execute(
+                'PRAGMA user_version = {}'.format(CACHE_SCHEMA_VERSION))
+        self.conn.executescript(CACHE_SCHEMA)
+        # Instance backoff state kept by earlier versions
+        self.conn.execute('DROP TABLE IF EXISTS hosts')
+
+    def _read(self, sql, params):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def _write(self, sql, params):
+        with self.lock:
+            self.conn.execute(sql, params)
+            self.writes += 1
+            if self.writes % CACHE_COMMIT_EVERY == 0:
+                self.conn.commit()
+
+    def get_entry(self, fid):
+        """
+        Return (status, payload, checked_at) for an account, or None.
+        status is 'ok' with the last toot datetime as payload, 'gone' with
+        the reason, or 'dead_instance' with the instance name.
+        """
+        row = self._read('SELECT status, payload, checked_at FROM toots '
+                         'WHERE fid=?', (fid,))
+        if row and row[0] == 'ok':
+            return row[0], datetime.fromisoformat(row[1]), row[2]
+        return row
+
+    def set_entry(self, fid, status, payload):
+        self._write('INSERT OR REPLACE INTO toots VALUES (?, ?, ?, ?)',
+                    (fid, status, payload, int(time.time())))
+
+    def set_last_toot(self, fid, last_toot):
+        self.set_entry(fid, 'ok', last_toot.isoformat())
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+def open_cache():
+    try:
+        return Cache(settings.CACHE_FILE)
+    except sqlite3.DatabaseError as e:
+        cprint(Fore.RED, "Error loading cache: {}".format(e))
+
+    # Not a cache we can read (e.g. an old pickle): set it aside and start
+    # a fresh one in its place
+    try:
+        os.replace(settings.CACHE_FILE, settings.CACHE_FILE + '.prev')
+        return Cache(settings.CACHE_FILE)
+    except (OSError, sqlite3.DatabaseError) as e:
+        cprint(Fore.RED, "Error creating cache: {}".format(e))
+        return Cache(None)
+
+
+def host_is_up(session, host):
+    """
+    Check once per run whether an instance answers its nodeinfo endpoint,
+    so that users on an instance assumed dead are settled by one probe
+    rather than a lookup each.
+    """
+    with host_probe_locks_lock:
+        lock = host_probe_locks[host]
+    with lock:
+        if host not in host_up:
+            try:
+                r = session.get(
+                    'https://{}/.well-known/nodeinfo'.format(host),
+                    timeout=PROBE_TIMEOUT)
+                host_up[host] = r.status_code < 500
+            except requests.RequestException:
+                host_up[host] = False
+        return host_up[host]
+
+
+def get_last_toot(mastodon, fid, cache, host=None, max_age=None):
+    """
+    Return (status, payload) for an account, as stored in the cache:
+    ('ok', last toot), ('gone', reason) or ('dead_instance', host).
+    Lookup failures other than on ASSUME_DEAD_INSTANCES are raised.
+
+    A cached last toot is used unless it was checked more than max_age
+    ago; negative entries expire after NEGATIVE_TTL.
+    """
+
+    entry = cache.get_entry(fid)
+    if entry:
+        status, payload, checked_at = entry
+        age = time.time() - checked_at
+        if status == 'ok':
+            fresh = max_age is None or age < max_age.total_seconds()
+        else:
+            fresh = age < NEGATIVE_TTL.total_seconds()
+        if fresh:
+            return status, payload
+
+    if (host in ASSUME_DEAD_INSTANCES and
+            not host_is_up(mastodon.session, host)):
+        cache.set_entry(fid, 'dead_instance', host)
+        return 'dead_instance', host
+
+    try:
+        statuses = mastodon.account_statuses(fid, limit=1)
+    except (Error, requests.RequestException, MastodonNetworkError):
+        if host in ASSUME_DEAD_INSTANCES:
+            cache.set_entry(fid, 'dead_instance', host)
+            return 'dead_instance', host
+        raise
 
-    if fid in cache and not force:
-        return cache[fid]
+    if not statuses:
+        reason = "No toot found - New way"
+        cache.set_entry(fid, 'gone', reason)
+        return 'gone', reason
+    result = statuses[0]['created_at']
 
-    statuses = mastodon.account_statuses(fid)
+    cache.set_last_toot(fid, result)
 
-    if not statuses:
-        raise UserGone("No toot found - New way")
-    result = min(t.get('created_at') for t in statuses)
+    return 'ok', result
 
-    if settings.CACHE_FILE:
-        cache[fid] = result
-        try:
-            if os.path.isfile(settings.CACHE_FILE):
-                shutil.copyfile(settings.CACHE_FILE, settings.CACHE_FILE + '.prev')
-            with open(settings.CACHE_FILE, 'wb') as f:
-                cache = pickle.dump(cache, f)
-        except Exception as e:
-            cprint(Fore.RED, "Error saving cache: {!r}".format(e))
 
-    return result
+def remove_follower(mastodon, fid):
+    """
+    Remove an account from your followers in one call, falling back to a
+    block and unblock on servers or Mastodon.py versions that predate
+    remove_from_followers (Mastodon 3.5).
+    """
+    if hasattr(mastodon, 'account_remove_from_followers'):
+        try:
+            mastodon.account_remove_from_followers(fid)
+            return
+        except (MastodonNotFoundError, MastodonVersionError):
+            pass
+    mastodon.account_block(fid)
+    mastodon.account_unblock(fid)
 
 
 def main():
@@ -120,11 +334,18 @@ def main():
     args = parser.parse_args()
 
     session = requests.Session()
+    # One kept-alive connection per worker thread
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS,
+                          pool_maxsize=MAX_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
 
     mastodon = Mastodon(
         access_token=settings.ACCESS_TOKEN,
         api_base_url=settings.API_BASE,
-        ratelimit_method='pace'
+        request_timeout=HTTP_TIMEOUT,
+        ratelimit_method='pace',
+        session=session
     )
 
     current_user = mastodon.account_verify_credentials()
@@ -144,9 +365,19 @@ def main():
         goal_msg = "(goal: n>={})".format(args.target_count)
 
     now = datetime.now(tz=timezone.utc)
+    cutoff = now - args.min_activity if args.min_activity else None
+    # A dry run may trust an inactive verdict checked this recently; an
+    # actual unfollow always re-fetches the last toot first
+    if args.unfollow or not args.min_activity:
+        recheck_age = timedelta(0)
+    else:
+        recheck_age = args.min_activity / 10
+
+    cache = open_cache()
+    atexit.register(cache.close)
 
     def clog(c, s):
-        tqdm.write(c + s + Fore.WHITE + Style.NORMAL)
+        tqdm.write(c + s + RESET)
 
     cprint(Fore.GREEN, "Current user: @{} (#{})".format(current_user['username'], uid))
     cprint(Fore.GREEN, "{}: {} {}".format(
@@ -158,103 +389,128 @@ def main():
     else:
         cprint(Fore.YELLOW, "Action: none")
 
-    followings = None
+    first_page = None
     if args.followers:
-        followings = mastodon.account_followers(uid)
+        first_page = mastodon.account_followers(uid, limit=PAGE_SIZE)
     else:
-        followings = mastodon.account_following(uid)
-    followings = mastodon.fetch_remaining(followings)
-
-    bar = tqdm(list(followings))
-    for f in bar:
+        first_page = mastodon.account_following(uid, limit=PAGE_SIZE)
+
+    relationships = {}
+
+    def iter_followings():
+        for page in iter_pages(mastodon, first_page):
+            if args.unmutuals:
+                ids = [f.get('id') for f in page]
+                for chunk in chunks(ids, RELATIONSHIPS_BATCH):
+                    # Accounts missing from a failed batch are reported
+                    # by classify()
+                    try:
+                        batch = mastodon.account_relationships(chunk)
+                    except (requests.RequestException, MastodonError) as e:
+                        clog(Fore.RED,
+                             "Error fetching relationships: {}".format(e))
+                        continue
+                    relationships.update((r['id'], r) for r in batch)
+            yield from page
+
+    def classify(f):
+        """
+        Decide what to do with an account, returning (verdict, info) where
+        verdict is 'unfollow', 'keep' or 'error'. Only does read-only
+        lookups, so it runs in the worker threads ahead of the main loop.
+        """
         fid = f.get('id')
-        acct = f.get('acct')
-        fullhandle = "@{}".format(acct)
+        inst = instance_of(f.get('acct'))
 
-        if '@' in acct:
-            inst = acct.split('@', 1)[1].lower()
-        else:
-            inst = None
-
-        if args.target_count is not None and local_count <= args.target_count:
-            clog(Fore.RED + Style.BRIGHT,
-                 "{} followings left; stopping".format(local_count))
-            break
+        if args.unmutuals:
+            relation = relationships.get(fid)
+            if relation is None:
+                return 'error', "No relationship returned"
+            if relation["following"] or relation["requested"]:
+                return 'keep', "Mutual"
+            return 'unfollow', "Unmutual ({})".format(relation)
 
-        title_printed = False
+        if not cutoff:
+            return 'keep', None
 
-        def title():
-            nonlocal title_printed
-            if title_printed:
-                return
-            title_printed = True
-            clog(Fore.WHITE + Style.BRIGHT,
-                 "Account: {} (#{})".format(f.get('acct'), fid))
-
-        if args.verbose:
-            title()
         try:
-            bar.set_description(fullhandle.ljust(30, ' '))
-
-            act = False
-
-            if args.unmutuals and inst not in settings.SKIP_INSTANCES:
-                try:
-                    relations = mastodon.account_relationships(fid)
-                    is_mutual = relations[0]["following"] or relations[0]["requested"]
-
-                    if not is_mutual:
-                        clog(Fore.YELLOW, "- Unmutual ({})".format(relations))
-                        act = True
-                except (UserGone, Error, requests.RequestException) as e:
-                    act = False
-                    clog(Fore.YELLOW, "- Exception ({})".format(e))
-
-            elif args.min_activity and inst not in settings.SKIP_INSTANCES:
-                try:
-                    last_toot = get_last_toot(mastodon, fid)
-                    if last_toot < now - args.min_activity:
-                        # force a cache miss to be Sure
-                        last_toot = get_last_toot(mastodon, fid, force=True)
-
-                    if last_toot < now - args.min_activity:
-                        act = True
-                        msg = "(!)"
-                        title()
-                        clog(Fore.WHITE, "- Last toot: {} {}".format(last_toot, msg))
-                    else:
-                        msg = "(pass)"
-                        if args.verbose:
-                            clog(Fore.WHITE, "- Last toot: {} {}".format(last_toot, msg))
-                except UserGone as e:
-                    moved = f.get('moved')
-                    if moved:
-                        # TODO: follow new account and unfollow old
-                        act = False
-                        title()
-                        clog(Fore.YELLOW,
-                             "- User moved ({}) [NOT IMPLEMENTED]".format(moved))
-                    else:
-                        act = True
-                        title()
-                        clog(Fore.YELLOW, "- User gone ({})".format(e))
-                except (Error, requests.RequestException) as e:
-                    if inst and inst in settings.ASSUME_DEAD_INSTANCES:
-                        act = True
-                        title()
-                        clog(Fore.YELLOW, "- Instance gone ({})".format(e))
-                    else:
-                        raise
-
-            if act:
+            status, payload = get_last_toot(mastodon, fid, cache, inst)
+            if status == 'ok' and payload < cutoff:
+                # force a cache miss to be Sure
+                status, payload = get_last_toot(
+                    mastodon, fid, cache, inst, max_age=recheck_age)
+        except (Error, requests.RequestException, MastodonError) as e:
+            return 'error', str(e)
+
+        if status == 'gone':
+            moved = f.get('moved')
+            if moved:
+                # TODO: follow new account and unfollow old
+                return ('error',
+                        "User moved ({}) [NOT IMPLEMENTED]".format(moved))
+            return 'unfollow', "User gone ({})".format(payload)
+        if status == 'dead_instance':
+            return 'unfollow', "Instance gone ({})".format(payload)
+
+        if payload < cutoff:
+            return 'unfollow', "Last toot: {} (!)".format(payload)
+        return 'keep', "Last toot: {} (pass)".format(payload)
+
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    results = fetch_ahead(executor, classify, iter_followings(),
+                          MAX_WORKERS * 4, skip=is_skipped)
+    bar = tqdm(results, total=followings_count, mininterval=0.5)
+    try:
+        for f, pending in bar:
+            fid = f.get('id')
+            acct = f.get('acct')
+            fullhandle = "@{}".format(acct)
+
+            if (args.target_count is not None and
+                    local_count <= args.target_count):
+                clog(Fore.RED + Style.BRIGHT,
+                     "{} followings left; stopping".format(local_count))
+                break
+
+            title_printed = False
+
+            def title():
+                nonlocal title_printed
+                if title_printed:
+                    return
+                title_printed = True
+                clog(Fore.WHITE + Style.BRIGHT,
+                     "Account: {} (#{})".format(f.get('acct'), fid))
+
+            if args.verbose:
+                title()
+            if pending is None:
+                if args.verbose:
+                    clog(Fore.WHITE, "- Skipped instance")
+                continue
+            try:
+                bar.set_description(fullhandle.ljust(30, ' '), refresh=False)
+
+                verdict, info = pending.result()
+
+                if verdict == 'keep':
+                    if args.verbose and info:
+                        clog(Fore.WHITE, "- {}".format(info))
+                    continue
+
+                title()
+                if verdict == 'error':
+                    clog(Fore.RED, "- Error: {}".format(info))
+                    continue
+
+                clog(Fore.YELLOW, "- {}".format(info))
                 local_count -= 1
 
                 if args.unfollow:
                     if args.followers:
                         clog(Fore.GREEN + Style.BRIGHT,
                              "- Removing follower {}".format(fullhandle))
-                        mastodon.account_block(fid)
-                        mastodon.account_unblock(fid)
+                        remove_follower(mastodon, fid)
                     else:
                         clog(Fore.GREEN + Style.BRIGHT,
                              "- Unfollowing {}".format(fullhandle))
@@ -265,10 +521,19 @@ def main():
 
                 clog(Fore.WHITE, ("- {}/{} followings left"
                                   .format(local_count, followings_count)))
-        except Exception as e:
-            title()
-            clog(Fore.RED, "- Error: {}".format(str(e)))
+            except (requests.RequestException, MastodonError) as e:
+                title()
+                clog(Fore.RED, "- Error: {}".format(str(e)))
+    finally:
+        # Don't wait on lookups for accounts we won't get to
+        results.close()
+        bar.close()
+        executor.shutdown()
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except Exception:
+        cprint(Fore.RED, "Fatal error:\n{}".format(traceback.format_exc()))
+        sys.exit(1)